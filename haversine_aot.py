@@ -0,0 +1,36 @@
+"""Ahead-of-time compiles the haversine kernel used by main.py into the haversine_ext module.
+
+Run `python haversine_aot.py` once (the Docker image does this at build time) so the bot
+does not have to JIT-compile the kernel when it starts.
+"""
+import math
+import numpy as np
+
+def haversine_batch(latitudes, longitudes, curr_latitude, curr_longitude):
+    """Calculates the distances in meters from one point to many points on the Earth using the haversine formula."""
+    R = 6371000  # radius of the Earth in meters
+
+    lat2 = math.radians(curr_latitude)
+    lon2 = math.radians(curr_longitude)
+    cos_lat2 = math.cos(lat2)
+
+    distances = np.empty_like(latitudes)
+    for i in range(latitudes.shape[0]):
+        lat1 = math.radians(latitudes[i])
+        lon1 = math.radians(longitudes[i])
+
+        # Haversine formula
+        dlat = lat1 - lat2
+        dlon = lon1 - lon2
+        a = math.sin(dlat / 2)**2 + math.cos(lat1) * cos_lat2 * math.sin(dlon / 2)**2
+        distances[i] = R * 2 * math.asin(math.sqrt(a))
+
+    return distances
+
+if __name__ == '__main__':
+    from numba.pycc import CC
+
+    cc = CC('haversine_ext')
+    # float32 coordinate arrays from bot_data, float64 user location
+    cc.export('haversine_batch', 'f4[:](f4[:], f4[:], f8, f8)')(haversine_batch)
+    cc.compile()
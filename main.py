@@ -1,9 +1,14 @@
 import logging
 import os
-import sys
-import signal
+import shelve
+import shutil
+import json
+import re
+from collections import OrderedDict
+import numpy as np
+from numba import njit
 import pandas as pd
-from math import radians, sin, cos, sqrt, atan2
+from scipy.spatial import cKDTree
 from telegram import ReplyKeyboardMarkup, ReplyKeyboardRemove, Update, KeyboardButton
 from telegram.ext import (
     Application,
@@ -15,7 +20,8 @@ from telegram.ext import (
 )
 from dotenv import load_dotenv
 import httpx
-import urllib.parse
+import aiofiles
+from haversine_aot import haversine_batch as haversine_kernel
 
 # Enable logging
 logging.basicConfig(
@@ -30,6 +36,36 @@ logger = logging.getLogger(__name__)
     REMINDER_FREQ, REMINDER_DAY, REMINDER_TIME
 ) = range(7)
 
+# Reminder inputs: day of the month (1-31) and 24-hour time (HHMM)
+DAY_PATTERN = re.compile(r'0*([1-9]|[12][0-9]|3[01])')
+TIME_PATTERN = re.compile(r'([01][0-9]|2[0-3])[0-5][0-9]')
+
+# Google Maps directions link, completed with the RVM's coordinates
+DIRECTIONS_BASE_URL = 'https://www.google.com/maps/dir/?api=1&destination='
+
+# Columns derived from data.csv at startup and not saved back
+DISPLAY_COLUMNS = ['status_emoji', 'nearby_bins']
+
+# Status updates not yet saved to data.csv, replayed on startup
+JOURNAL_PATH = 'journal.log'
+
+# Shared OneMap client so connections are kept alive across requests
+HTTP_CLIENT = httpx.AsyncClient(
+    base_url="https://www.onemap.gov.sg",
+    timeout=httpx.Timeout(5.0),
+    limits=httpx.Limits(max_keepalive_connections=10),
+)
+
+# Search queries are limited to ASCII letters, digits and spaces
+QUERY_PATTERN = re.compile(r'[A-Za-z0-9 ]+')
+
+# Geocoded queries, evicting the least recently used once full
+GEOCODE_CACHE_SIZE = 1024
+_geocode_cache = OrderedDict()
+# Every geocoded query, kept on disk so the cache survives restarts
+GEOCODE_DB_PATH = 'geocache.db'
+_geocode_db = shelve.open(GEOCODE_DB_PATH)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Starts the conversation and asks the user about their choice."""
     reply_keyboard = [["/find"], ["/report"], ["/set"]]
@@ -97,44 +133,40 @@ async def find_rvm_location(update: Update, context: ContextTypes.DEFAULT_TYPE)
 
 async def get_lat_long_from_query(query: str) -> tuple:
     """Fetches latitude and longitude from a location, building, or postal code using OneMap API."""
-    if not query.replace(" ", "").isalnum():
+    if not QUERY_PATTERN.fullmatch(query):
         raise ValueError("Invalid query: Only alphanumeric characters and spaces are allowed.")
-    encoded_query = urllib.parse.quote(query)
-    url = f"https://www.onemap.gov.sg/api/common/elastic/search?searchVal={encoded_query}&returnGeom=Y&getAddrDetails=Y&pageNum=1"
-    async with httpx.AsyncClient() as client:
-        response = await client.get(url)
-    data = response.json()
-    if data['found'] > 0:
-        return float(data['results'][0]['LATITUDE']), float(data['results'][0]['LONGITUDE'])
+
+    key = " ".join(query.lower().split())
+    if key in _geocode_cache:
+        _geocode_cache.move_to_end(key)
+        return _geocode_cache[key]
+
+    if key in _geocode_db:
+        result = _geocode_db[key]
     else:
-        raise ValueError("Invalid query or no results found")
+        response = await HTTP_CLIENT.get(
+            "/api/common/elastic/search",
+            params={"searchVal": query, "returnGeom": "Y", "getAddrDetails": "Y", "pageNum": 1},
+        )
+        data = response.json()
+        if data['found'] == 0:
+            raise ValueError("Invalid query or no results found")
+        result = float(data['results'][0]['LATITUDE']), float(data['results'][0]['LONGITUDE'])
+        _geocode_db[key] = result
+
+    _geocode_cache[key] = result
+    if len(_geocode_cache) > GEOCODE_CACHE_SIZE:
+        _geocode_cache.popitem(last=False)
+    return result
         
 async def find_nearest_rvms(update: Update, context: ContextTypes.DEFAULT_TYPE, curr_latitude: float, curr_longitude: float) -> None:
     """Finds the nearest RVMs based on the provided latitude and longitude."""
-    directions_base_url = 'https://www.google.com/maps/dir/?api=1&destination='
+    result_df = get_nearest_rvms(context.bot_data, curr_latitude, curr_longitude)
 
-    df = context.bot_data['df']
-    df_copy = df.copy()
-    df_copy['distances'] = df_copy.apply(
-        lambda x: distance(x['Longitude'], x['Latitude'], curr_longitude, curr_latitude), axis=1
-    )
-    result_df = df_copy.sort_values('distances').iloc[0:3]
-
-    response = "Here are the 3 nearest RVMs:\n"
-    for _, row in result_df.iterrows():
-        status_emoji = "🟢" if row['Status'] == "Working" else "🔴"
-        nearby_bins = f'<b>[Test Feature] Nearby Bins:</b> {row["Nearby"]}' if row["Nearby"] not in ["None", None, float('nan')] else ""
-        response += (
-            f'{status_emoji} <b><u>{row["Name"]}</u></b> ({row["distances"]:.0f} meters) \n'
-            f'{row["Address"]} \n'
-            f'{row["Description"]} \n'
-            f'<b>Hours:</b> {row["Hours"]} \n'
-            f'<b>Status:</b> {row["Status"]} \n'
-            f'{nearby_bins} \n'
-            f'<b>Get Directions</b>: {directions_base_url}{row["Latitude"]},{row["Longitude"]} \n\n'
-        )
+    parts = ["Here are the 3 nearest RVMs:"]
+    parts.extend(format_rvm(row) for row in result_df.itertuples(index=False))
     await update.message.reply_text(
-        response, parse_mode='HTML', disable_web_page_preview=True,
+        "\n".join(parts), parse_mode='HTML', disable_web_page_preview=True,
         reply_markup=ReplyKeyboardRemove()
     )
 
@@ -154,19 +186,15 @@ async def report_rvm_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 async def report_rvm_location(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles the user's location and presents the nearest RVMs."""
     curr_latitude, curr_longitude = update.message.location.latitude, update.message.location.longitude
-    directions_base_url = 'https://www.google.com/maps/dir/?api=1&destination='
+    result_df = get_nearest_rvms(context.bot_data, curr_latitude, curr_longitude)
 
-    df = context.bot_data['df']
-    df_copy = df.copy()
-    df_copy['distances'] = df_copy.apply(
-        lambda x: distance(x['Longitude'], x['Latitude'], curr_longitude, curr_latitude), axis=1
+    # Render the listings now so the alternatives can be shown after the report without re-formatting
+    context.user_data['nearest_rvms'] = result_df.assign(
+        display=[format_rvm(row) for row in result_df.itertuples(index=False)]
     )
-    result_df = df_copy.sort_values('distances').iloc[0:3]
-
-    context.user_data['nearest_rvms'] = result_df
 
     response = "Thanks! Based on your location, here are the 3 nearest RVMs.\n"
-    reply_keyboard = [[row['Name']] for _, row in result_df.iterrows()]
+    reply_keyboard = [[name] for name in result_df['Name']]
     response += "\nWhich RVM would you like to report on?"
     await update.message.reply_text(
         response, reply_markup=ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True, resize_keyboard=True)
@@ -176,10 +204,10 @@ async def report_rvm_location(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def report_rvm_choice(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handles the user's RVM choice and asks for the status."""
     user_choice = update.message.text
-    context.user_data['selected_rvm'] = user_choice
-    rvm_name = context.user_data['nearest_rvms'].loc[
-        context.user_data['nearest_rvms']['Name'] == user_choice, 'Name'
-    ].values[0]
+    df = context.bot_data['df']
+    idx = context.bot_data['name_idx'][user_choice]
+    context.user_data['selected_rvm_idx'] = idx
+    rvm_name = df.iat[idx, df.columns.get_loc('Name')]
     reply_keyboard = [["Working", "Full"], ["Out of Order", "Other Issues"]]
     await update.message.reply_text(
         f"You've selected the RVM at {rvm_name}. What's the current status?",
@@ -191,36 +219,24 @@ async def report_rvm_status(update: Update, context: ContextTypes.DEFAULT_TYPE)
     """Handles the user's status report and confirms the report."""
     user_choice = update.message.text
     context.user_data['rvm_status'] = user_choice
-    rvm_name = context.user_data['nearest_rvms'].loc[
-        context.user_data['nearest_rvms']['Name'] == context.user_data['selected_rvm'], 'Name'
-    ].values[0]
-    context.bot_data['df'].loc[context.bot_data['df']['Name'] == rvm_name, 'Status'] = user_choice
+    df = context.bot_data['df']
+    idx = context.user_data['selected_rvm_idx']
+    rvm_name = df.iat[idx, df.columns.get_loc('Name')]
+    df.iat[idx, df.columns.get_loc('Status')] = user_choice
+    df.iat[idx, df.columns.get_loc('status_emoji')] = status_emoji(user_choice)
+    await append_journal(rvm_name, user_choice)
+
+    parts = [f"Thank you for letting us know! The RVM at <u><b>{rvm_name}</b></u> is currently <u><b>{user_choice}</b></u>."]
 
-    response = f"Thank you for letting us know! The RVM at <u><b>{rvm_name}</b></u> is currently <u><b>{user_choice}</b></u>."
-    
     if user_choice.lower() != "working":
         # Get the alternative 2 locations
-        selected_rvm_index = context.user_data['nearest_rvms'].index[
-            context.user_data['nearest_rvms']['Name'] == context.user_data['selected_rvm']
-        ][0]
-        alternative_rvms = context.user_data['nearest_rvms'].drop(selected_rvm_index).iloc[0:2]
-
-        response += "\n\nHere are the statuses of the alternative 2 nearest RVMs:\n"
-        directions_base_url = 'https://www.google.com/maps/dir/?api=1&destination='
-        for _, row in alternative_rvms.iterrows():
-            status_emoji = "🟢" if row['Status'] == "Working" else "🔴"
-            nearby_bins = f'<b>[Test Feature] Nearby Bins:</b> {row["Nearby"]}' if row["Nearby"] != "None" else ""
-            response += (
-                f'{status_emoji} <b><u>{row["Name"]}</u></b> ({row["distances"]:.0f} meters) \n'
-                f'{row["Address"]} \n'
-                f'{row["Description"]} \n'
-                f'<b>Hours:</b> {row["Hours"]} \n'
-                f'<b>Status:</b> {row["Status"]} \n'
-                f'{nearby_bins} \n'
-                f'<b>Get Directions</b>: {directions_base_url}{row["Latitude"]},{row["Longitude"]} \n\n'
-            )
-
-    await update.message.reply_text(response, reply_markup=ReplyKeyboardRemove(), parse_mode='HTML', disable_web_page_preview=True)
+        nearest_rvms = context.user_data['nearest_rvms']
+        alternative_rvms = nearest_rvms[nearest_rvms['Name'] != rvm_name].iloc[0:2]
+
+        parts.append("\nHere are the statuses of the alternative 2 nearest RVMs:")
+        parts.extend(alternative_rvms['display'])
+
+    await update.message.reply_text("\n".join(parts), reply_markup=ReplyKeyboardRemove(), parse_mode='HTML', disable_web_page_preview=True)
     context.user_data.clear()
     return ConversationHandler.END
 
@@ -287,53 +303,132 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
     await update.message.reply_text("An error occurred while processing your request. Please try again later.")
 
-def distance(lon1, lat1, lon2, lat2):
-    """Calculates the distance between two points on the Earth using the haversine formula."""
-    R = 6371000  # radius of the Earth in meters
-
-    lat1, lon1, lat2, lon2 = map(radians, [lat1, lon1, lat2, lon2])
-
-    # Haversine formula
-    dlon = lon2 - lon1
-    dlat = lat2 - lat1
-    a = sin(dlat / 2)**2 + cos(lat1) * cos(lat2) * sin(dlon / 2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+def to_unit_vectors(latitude, longitude):
+    """Converts latitudes and longitudes in degrees to Cartesian coordinates on the unit sphere."""
+    lat, lon = np.radians(latitude), np.radians(longitude)
+    return np.stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1)
+
+try:
+    # Built ahead of time by `python haversine_aot.py`
+    from haversine_ext import haversine_batch
+except ImportError:
+    haversine_batch = njit(fastmath=True, cache=True)(haversine_kernel)
+    # Compile at import so the first user request does not pay the JIT cost
+    haversine_batch(np.zeros(1, np.float32), np.zeros(1, np.float32), 0.0, 0.0)
+
+def get_nearest_rvms(bot_data: dict, curr_latitude: float, curr_longitude: float, k: int = 3) -> pd.DataFrame:
+    """Returns the k nearest RVMs to the given location, sorted by distance."""
+    df = bot_data['df']
+    tree = bot_data['tree']
+    query = to_unit_vectors(curr_latitude, curr_longitude)
+
+    # Chord distance is monotonic with great-circle distance, so the nearest neighbours are the same
+    _, nearest = tree.query(query, k=min(k, tree.n))
+    nearest = np.atleast_1d(nearest)
+
+    distances = haversine_batch(bot_data['lat'][nearest], bot_data['lon'][nearest], curr_latitude, curr_longitude)
+    return df.iloc[nearest].assign(distances=distances)
+
+def status_emoji(status: str) -> str:
+    """Returns the emoji shown next to an RVM with the given status."""
+    return "🟢" if status == "Working" else "🔴"
+
+def format_rvm(row) -> str:
+    """Formats an RVM row, including its distance, as an HTML block for a reply."""
+    return (
+        f'{row.status_emoji} <b><u>{row.Name}</u></b> ({row.distances:.0f} meters) \n'
+        f'{row.Address} \n'
+        f'{row.Description} \n'
+        f'<b>Hours:</b> {row.Hours} \n'
+        f'<b>Status:</b> {row.Status} \n'
+        f'{row.nearby_bins} \n'
+        f'<b>Get Directions</b>: {DIRECTIONS_BASE_URL}{row.Latitude},{row.Longitude} \n'
+    )
 
-    return R * c
+def add_display_columns(df) -> None:
+    """Precomputes the per-RVM strings used when listing RVMs."""
+    df['status_emoji'] = df['Status'].map(status_emoji)
+    has_nearby = df['Nearby'].notna() & (df['Nearby'] != "None")
+    df['nearby_bins'] = np.where(has_nearby, '<b>[Test Feature] Nearby Bins:</b> ' + df['Nearby'].astype(str), "")
 
 def validate_reminder_day(day: str) -> bool:
     """Validates the reminder day input."""
-    return day.isdigit() and 1 <= int(day) <= 31
+    return DAY_PATTERN.fullmatch(day) is not None
 
 def validate_reminder_time(time: str) -> bool:
     """Validates the reminder time input."""
-    return time.isdigit() and len(time) == 4 and 0 <= int(time[:2]) < 24 and 0 <= int(time[2:]) < 60
+    return TIME_PATTERN.fullmatch(time) is not None
 
-def signal_handler(sig, frame):
-    """Handles the signal for saving data and exiting."""
-    print('Saving data and exiting...')
+async def post_shutdown(application: Application) -> None:
+    """Saves the data and releases resources held for the lifetime of the bot."""
     save_dataframe(application.bot_data['df'])
-    sys.exit(0)
+    _geocode_db.close()
+    await HTTP_CLIENT.aclose()
+
+async def append_journal(rvm_name: str, status: str) -> None:
+    """Records a status update in the journal so it survives a crash before the next save."""
+    async with aiofiles.open(JOURNAL_PATH, 'a') as journal:
+        await journal.write(json.dumps([rvm_name, status]) + "\n")
+
+def replay_journal(df, name_idx) -> None:
+    """Applies the status updates recorded since the last save to the DataFrame."""
+    if not os.path.exists(JOURNAL_PATH):
+        return
+    status_col = df.columns.get_loc('Status')
+    with open(JOURNAL_PATH) as journal:
+        for line in journal:
+            try:
+                rvm_name, status = json.loads(line)
+            except ValueError:
+                # A crash mid-write can leave a truncated last line
+                logger.warning("Skipping malformed journal entry: %r", line)
+                continue
+            if rvm_name in name_idx:
+                df.iat[name_idx[rvm_name], status_col] = status
+
+def load_dataframe() -> pd.DataFrame:
+    """Loads the DataFrame from the CSV file, using Arrow-backed columns when pyarrow is installed."""
+    try:
+        return pd.read_csv('data.csv', engine='pyarrow', dtype_backend='pyarrow')
+    except ImportError:
+        return pd.read_csv('data.csv')
 
 def save_dataframe(df):
-    """Saves the DataFrame to a CSV file."""
-    df.to_csv('data.csv', index=False)
+    """Saves the DataFrame to a CSV file atomically and clears the journal it now includes."""
+    df.drop(columns=DISPLAY_COLUMNS).to_csv('data.csv.tmp', index=False)
+    try:
+        os.replace('data.csv.tmp', 'data.csv')
+    except OSError:
+        # docker-compose bind-mounts data.csv as a single file, which cannot be replaced by a rename
+        shutil.copyfile('data.csv.tmp', 'data.csv')
+        os.remove('data.csv.tmp')
+    if os.path.exists(JOURNAL_PATH):
+        os.remove(JOURNAL_PATH)
     print("Data saved to data.csv")
 
 def main() -> None:
     """Main function to run the bot."""
-    global application
-    df = pd.read_csv('data.csv')
+    df = load_dataframe()
+    name_idx = {name: i for i, name in enumerate(df['Name'])}
+    replay_journal(df, name_idx)
+    add_display_columns(df)
     load_dotenv()
     TOKEN = os.getenv('BOT_TOKEN')
     if not TOKEN:
         raise Exception('Bot token is not defined')
 
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(TOKEN).build()
+    application = Application.builder().token(TOKEN).post_shutdown(post_shutdown).build()
 
     # Store the DataFrame in the bot_data
     application.bot_data['df'] = df
+    application.bot_data['name_idx'] = name_idx
+    # Contiguous float32 coordinates for the distance kernel; the DataFrame is only used for the text columns
+    application.bot_data['lat'] = df['Latitude'].to_numpy(np.float32)
+    application.bot_data['lon'] = df['Longitude'].to_numpy(np.float32)
+    # Spatial index over the unit-sphere coordinates of the RVMs, rebuilt only when data.csv is reloaded
+    xyz = to_unit_vectors(application.bot_data['lat'], application.bot_data['lon']).astype(np.float32)
+    application.bot_data['tree'] = cKDTree(xyz)
 
     find_rvm_conv_handler = ConversationHandler(
         entry_points=[CommandHandler("find", find_rvm_start)],
@@ -375,16 +470,9 @@ def main() -> None:
     application.add_handler(reminder_conv_handler, 4)
     application.add_error_handler(error_handler)
 
-    # Set up signal handler
-    signal.signal(signal.SIGINT, signal_handler)
-    signal.signal(signal.SIGTERM, signal_handler)
-
-    try:
-        # Run the bot until the user presses Ctrl-C
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
-    finally:
-        # Save the data when the program exits
-        save_dataframe(application.bot_data['df'])
+    # Run the bot until the user presses Ctrl-C or the process receives SIGTERM;
+    # the data is saved in post_shutdown
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file